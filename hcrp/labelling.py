@@ -1,7 +1,5 @@
-from cellpose.models import Cellpose
-from cellpose import plot
 import numpy as np
-from skimage.measure import regionprops
+import tifffile
 from skimage.io import imread
 import matplotlib.pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap
@@ -10,7 +8,124 @@ import cv2
 import os
 import datetime
 import pandas as pd
-import bigfish.detection as detection
+
+try:
+    from numba import njit, prange
+
+    _HAVE_NUMBA = True
+except ImportError:
+    _HAVE_NUMBA = False
+
+# resolve the colormap once instead of a registry lookup per imshow
+_AFMHOT = plt.get_cmap("afmhot")
+
+
+def __getattr__(name):
+    # lazy imports (PEP 562): cellpose pulls in torch and bigfish pulls in
+    # its whole detection stack, neither of which labelling itself needs
+    if name == "Cellpose":
+        from cellpose.models import Cellpose
+
+        return Cellpose
+    if name == "plot":
+        from cellpose import plot
+
+        return plot
+    if name == "regionprops":
+        from skimage.measure import regionprops
+
+        return regionprops
+    if name == "detection":
+        import bigfish.detection as detection
+
+        return detection
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+if _HAVE_NUMBA:
+
+    @njit(parallel=True, cache=True)
+    def _equalize_u16_to_u8(img16, out8):
+        """Fused downshift + histogram + LUT-apply, two passes over the image."""
+        h, w = img16.shape
+        hist = np.zeros(256, np.int64)
+        for i in prange(h):
+            local = np.zeros(256, np.int64)
+            for j in range(w):
+                local[img16[i, j] >> 8] += 1
+            hist += local
+        first = 0
+        while first < 255 and hist[first] == 0:
+            first += 1
+        lut = np.zeros(256, np.uint8)
+        denom = h * w - hist[first]
+        if denom > 0:
+            scale = 255.0 / denom
+            cdf = 0
+            for v in range(256):
+                cdf += hist[v]
+                if v >= first:
+                    lut[v] = min(255, max(0, int(round((cdf - hist[first]) * scale))))
+        for i in prange(h):
+            for j in range(w):
+                out8[i, j] = lut[img16[i, j] >> 8]
+
+
+def _equalize_uint8(img16, out=None):
+    """Downshift a uint16 image to uint8 and histogram-equalize it with a LUT.
+
+    Equivalent to ``cv2.equalizeHist((img16 // 256).astype(np.uint8))`` but
+    builds the LUT vectorized and writes the downshifted image into a
+    reusable buffer instead of allocating intermediates. With numba
+    installed, the downshift, histogram and LUT application are fused
+    into a parallel two-pass kernel.
+    """
+    if out is None:
+        out = np.empty(img16.shape, np.uint8)
+    if _HAVE_NUMBA:
+        _equalize_u16_to_u8(img16, out)
+        return out
+    np.right_shift(img16, 8, out=out, casting="unsafe")
+    hist = np.bincount(out.ravel(), minlength=256)
+    return _equalize_lut(hist)[out]
+
+
+def _equalize_lut(hist):
+    """Build the 256-entry equalization LUT for a uint8 histogram."""
+    cdf = hist.cumsum()
+    # match cv2.equalizeHist: stretch from the first populated bin
+    nz = np.flatnonzero(hist)
+    first = nz[0] if nz.size else 0
+    denom = cdf[-1] - hist[first]
+    lut = np.zeros(256, np.uint8)
+    if denom:
+        lut[first:] = np.clip(
+            np.round((cdf[first:] - hist[first]) * (255.0 / denom)), 0, 255
+        ).astype(np.uint8)
+    return lut
+
+
+def _equalize_channels(imgs16, out=None):
+    """Histogram-equalize every channel of a (C, H, W) uint16 array.
+
+    Returns a (C, H, W) uint8 array. One uint8 scratch buffer takes every
+    channel's downshift and the equalized channels are written into a
+    single preallocated block, so no per-channel temporaries are left to
+    the allocator.
+    """
+    n_channels = imgs16.shape[0]
+    if out is None:
+        out = np.empty(imgs16.shape, np.uint8)
+    if _HAVE_NUMBA:
+        for c in range(n_channels):
+            _equalize_u16_to_u8(imgs16[c], out[c])
+        return out
+    scratch = np.empty(imgs16.shape[1:], np.uint8)
+    for c in range(n_channels):
+        np.right_shift(imgs16[c], 8, out=scratch, casting="unsafe")
+        lut = _equalize_lut(np.bincount(scratch.ravel(), minlength=256))
+        np.take(lut, scratch, out=out[c])
+    return out
 
 
 class FixedSizeRectangleSelector(RectangleSelector):
@@ -28,32 +143,41 @@ class FixedSizeRectangleSelector(RectangleSelector):
         - Translate
         """
         eventpress = self._eventpress
-        # The calculations are done for rotation at zero: we apply inverse
-        # transformation to events except when we rotate and move
         move = self._active_handle == "C"
 
         xdata, ydata = self._get_data_coords(event)
         dx = xdata - eventpress.xdata
         dy = ydata - eventpress.ydata
-        x0, x1, y0, y1 = self._extents_on_press
-        if move:
+        # assigning extents redraws the selector, so skip no-op moves
+        if move and (dx or dy):
             x0, x1, y0, y1 = self._extents_on_press
-            dx = xdata - eventpress.xdata
-            dy = ydata - eventpress.ydata
-            x0 += dx
-            x1 += dx
-            y0 += dy
-            y1 += dy
-        self.extents = x0, x1, y0, y1
+            self.extents = x0 + dx, x1 + dx, y0 + dy, y1 + dy
+
+    def update(self):
+        """Blit only the selection rectangle while translating.
+
+        The base implementation restores the background and then redraws
+        every handle artist on each motion event; during a drag the
+        rectangle is the only artist that needs repainting. The full
+        redraw still runs on press/release so the handles reappear.
+        """
+        if (
+            self.useblit
+            and self._active_handle == "C"
+            and self.background is not None
+        ):
+            self.canvas.restore_region(self.background)
+            self.ax.draw_artist(self._selection_artist)
+            self.canvas.blit(self.ax.bbox)
+            return False
+        return super().update()
 
 
 def get_midline(stack, z, name, window_name=None):
     """Manually Select ROI midline Points From Image."""
     image = stack[z]
-    image_with_roi = image.copy()
-    img8bit = (image_with_roi / 256).astype(np.uint8)
-    image_with_roi_equalized = cv2.equalizeHist(img8bit)
-    image_with_roi_equalized = np.dstack([image_with_roi_equalized] * 3)
+    image_with_roi_equalized = _equalize_uint8(image)
+    image_with_roi_equalized = cv2.cvtColor(image_with_roi_equalized, cv2.COLOR_GRAY2BGR)
     current_image = image_with_roi_equalized.copy()
     roi_points = []
     if window_name is None:
@@ -78,7 +202,9 @@ def get_midline(stack, z, name, window_name=None):
     cv2.imshow(window_name, current_image)
     cv2.setMouseCallback(window_name, mouse_callback)
     while True:
-        key = cv2.waitKey(1) & 0xFF
+        # block until a key arrives; waitKey still pumps the event loop,
+        # so mouse callbacks keep firing while we sleep
+        key = cv2.waitKey(0) & 0xFF
         if key == ord("q"):
             if len(roi_points) > 1:
                 cv2.destroyAllWindows()
@@ -128,54 +254,77 @@ def get_mean_region(image, high_contrast, name, size=50, vmax=None):
     """Allow the user to to select the location of a rectangular region of interest in an image and return the mean value of the region.
     The selector should be of a fixed size and the user should be able to move it around the image.
     """
-    fig, ax = plt.subplots()
     if high_contrast is None:
         high_contrast = image
-    ax.imshow(high_contrast, cmap="afmhot")
-    ax.set_title(f"{name}")
+    # display a downsampled copy to keep redraws cheap; the data extent
+    # keeps selector coordinates in full-resolution pixels so the mean is
+    # still taken from the full-resolution image
+    h, w = high_contrast.shape[:2]
+    scale = max(h, w) / 1024.0
+    if scale > 1:
+        display = cv2.resize(
+            high_contrast,
+            (int(w / scale), int(h / scale)),
+            interpolation=cv2.INTER_AREA,
+        )
+    else:
+        display = high_contrast
+    # summed-area table: each selection mean is then four lookups instead
+    # of a size x size reduction
+    img_h, img_w = image.shape[:2]
+    integral = cv2.integral(image.astype(np.float64))
     means = []
     centers = []
+    while True:
+        fig, ax = plt.subplots()
+        ax.imshow(display, cmap=_AFMHOT, extent=(0, w, h, 0))
+        ax.set_title(f"{name}")
 
-    def onselect(eclick, erelease):
-        # x1, y1 = int(eclick.xdata), int(eclick.ydata)
-        # x2, y2 = int(erelease.xdata), int(erelease.ydata)
-        # region = image[y1:y2, x1:x2]
-        # means.append(np.mean(region))
-        # centers.append((x1 + x2) / 2, (y1 + y2) / 2)
-        # print(f"Mean value of {name}: {means[-1]}")
-        extent = selector.extents
-        x1, x2, y1, y2 = [int(e) for e in extent]
-        region = image[y1:y2, x1:x2]
-        means.append(np.mean(region))
-        centers.append([(x1 + x2) / 2, (y1 + y2) / 2])
-
-    selector = FixedSizeRectangleSelector(
-        ax,
-        onselect,
-        size=size,
-        useblit=True,
-        button=[1, 3],  # disable middle button
-        minspanx=5,
-        minspany=5,
-        spancoords="data",
-        interactive=True,
-    )
+        def onselect(eclick, erelease):
+            extent = selector.extents
+            x1, x2, y1, y2 = [int(e) for e in extent]
+            x1, y1 = max(x1, 0), max(y1, 0)
+            x2, y2 = min(x2, img_w), min(y2, img_h)
+            area = (y2 - y1) * (x2 - x1)
+            if area <= 0:
+                return
+            total = (
+                integral[y2, x2]
+                - integral[y1, x2]
+                - integral[y2, x1]
+                + integral[y1, x1]
+            )
+            means.append(total / area)
+            centers.append([(x1 + x2) / 2, (y1 + y2) / 2])
 
-    def reset(event):
-        if event.key == "r":
-            means.clear()
-            selector.extents = 0, size, 0, size
-            selector.update()
-            ax.set_title(f"Select a region of interest for {name}")
-            fig.canvas.draw()
+        selector = FixedSizeRectangleSelector(
+            ax,
+            onselect,
+            size=size,
+            useblit=True,
+            button=[1, 3],  # disable middle button
+            minspanx=5,
+            minspany=5,
+            spancoords="data",
+            interactive=True,
+        )
 
-    fig.canvas.mpl_connect("key_press_event", reset)
-    plt.show()
-    try:
-        return means[-1], centers[-1]
-    except IndexError:
+        def reset(event):
+            if event.key == "r":
+                means.clear()
+                selector.extents = 0, size, 0, size
+                selector.update()
+                ax.set_title(f"Select a region of interest for {name}")
+                # draw_idle coalesces repeated resets into one redraw when
+                # the event loop next idles, instead of a synchronous draw
+                # per keypress
+                fig.canvas.draw_idle()
+
+        fig.canvas.mpl_connect("key_press_event", reset)
+        plt.show()
+        if means:
+            return means[-1], centers[-1]
         print("No region selected.")
-        return get_mean_region(image, high_contrast, name, size, vmax)
 
 
 def get_z(stack, label_location, name, window_name=None, z=None):
@@ -184,10 +333,8 @@ def get_z(stack, label_location, name, window_name=None, z=None):
     if z is None:
         z = z_midline
     image = stack[z]
-    image_with_roi = image.copy()
-    img8bit = (image_with_roi / 256).astype(np.uint8)
-    image_with_roi_equalized = cv2.equalizeHist(img8bit)
-    image_with_roi_equalized = np.dstack([image_with_roi_equalized] * 3)
+    image_with_roi_equalized = _equalize_uint8(image)
+    image_with_roi_equalized = cv2.cvtColor(image_with_roi_equalized, cv2.COLOR_GRAY2BGR)
     if window_name is None:
         window_name = f"Select z for {name}"
     cv2.namedWindow(window_name, cv2.WINDOW_NORMAL)
@@ -202,7 +349,9 @@ def get_z(stack, label_location, name, window_name=None, z=None):
     )
     cv2.imshow(window_name, image_with_roi_equalized)
     while True:
-        key = cv2.waitKey(1) & 0xFF
+        # block until a key arrives; waitKey still pumps the event loop,
+        # so mouse callbacks keep firing while we sleep
+        key = cv2.waitKey(0) & 0xFF
         if key == ord("q"):
             break
         if key == ord("u"):
@@ -242,45 +391,68 @@ def label(
     assert channel_names[-1] == "nuclear", "The last channel must be nuclear."
     if not os.path.exists(out):
        os.makedirs(out)
-    stack = imread(stack_path)
+    try:
+        # map the stack instead of loading it: only the planes actually
+        # indexed get read from disk
+        stack = tifffile.memmap(stack_path, mode="r")
+    except ValueError:
+        # memmap needs uncompressed, contiguous data; fall back to an
+        # eager read for compressed TIFFs
+        stack = imread(stack_path)
     name = stack_path.split("/")[-1]
     mid_layer = int(mid_frac * stack.shape[0])
-    nuclear = stack[mid_layer, :, :, 3]
+    # one contiguous (C, H, W) copy of the mid layer: channel slices below
+    # are then contiguous blocks instead of strided views that OpenCV and
+    # the LUT pass would have to copy internally
+    mid_slice = np.ascontiguousarray(stack[mid_layer].transpose(2, 0, 1))
+    nuclear = mid_slice[3]
     contour = get_contour(stack[:, :, :, -1], mid_layer, name)
-    contour = np.hstack([contour])
+    contour = np.asarray(contour, dtype=np.int32)
     contour_out = f"{out}/{name}_contour.csv"
     contour_df = pd.DataFrame(contour, columns=["x", "y", "z"])
-    contour_df.to_csv(contour_out, index=False)
+    contour_df = contour_df.astype({"x": "float32", "y": "float32", "z": "int32"})
+    contour_df.to_csv(contour_out, index=False, float_format="%.4f", lineterminator="\n")
     print(f"Contour points saved to {contour_out}.")
     endoderm = get_endoderm(stack[:, :, :, -1], mid_layer, name)
-    endoderm = np.hstack([endoderm])
+    endoderm = np.asarray(endoderm, dtype=np.int32)
     endoderm_out = f"{out}/{name}_endoderm.csv"
     endoderm_df = pd.DataFrame(endoderm, columns=["x", "y", "z"])
-    endoderm_df.to_csv(endoderm_out, index=False)
+    endoderm_df = endoderm_df.astype({"x": "float32", "y": "float32", "z": "int32"})
+    endoderm_df.to_csv(endoderm_out, index=False, float_format="%.4f", lineterminator="\n")
     print(f"Endoderm points saved to {endoderm_out}.")
     midline = get_midline(stack[:, :, :, -1], contour[0, 2], name)
+    midline = np.asarray(midline, dtype=np.int32)
     midline_out = f"{out}/{name}_midline.csv"
     midline_df = pd.DataFrame(midline, columns=["x", "y", "z"])
-    midline_df.to_csv(midline_out, index=False)
+    midline_df = midline_df.astype({"x": "float32", "y": "float32", "z": "int32"})
+    midline_df.to_csv(midline_out, index=False, float_format="%.4f", lineterminator="\n")
     print(f"midline points saved to {out}/{name}_midline.csv.")
     background_out = f"{out}/{name}_background.csv"
     columns = ["mean_intensity", "window_length", "x", "y", "z"]
     if background:
-        background_df = pd.DataFrame(columns=columns)
+        bg_rows = []
+        index = []
+        equalized = _equalize_channels(mid_slice[: len(channel_names) - 1])
         for j, channel_name in enumerate(channel_names[:-1]):
-            channel = stack[mid_layer, :, :, j]
-            normalized_channel = (channel // 256).astype(np.uint8)
-            normalized_channel = cv2.equalizeHist(normalized_channel)
+            channel = mid_slice[j]
             background, background_center = get_mean_region(
-                channel, normalized_channel, f"{name} Background {channel_name}", size=size
+                channel, equalized[j], f"{name} Background {channel_name}", size=size
             )
-            background_df.loc[channel_name] = [
-                background,
-                size,
-                *background_center,
-                mid_layer,
-            ]
-        background_df.to_csv(background_out, index=True)
+            index.append(channel_name)
+            bg_rows.append((background, size, *background_center, mid_layer))
+        background_df = pd.DataFrame.from_records(bg_rows, columns=columns, index=index)
+        background_df = background_df.astype(
+            {
+                "mean_intensity": "float64",
+                "window_length": "int32",
+                "x": "float64",
+                "y": "float64",
+                "z": "int32",
+            }
+        )
+        background_df.to_csv(
+            background_out, index=True, float_format="%.4f", lineterminator="\n"
+        )
         print(f"Backgound data saved to {background_out}.")
     print(f"Finished labelling {stack_path}.")
 
@@ -1,5 +1,6 @@
 from cellpose.models import Cellpose
 import numpy as np
+import tifffile
 from skimage import measure
 from skimage.io import imread
 import matplotlib.pyplot as plt
@@ -37,10 +38,15 @@ def process_layer(
         assert len(hcr_params) == len(
             channel_names
         ), "HCR Params must match non-nuclear channels"
-    stack = imread(f"{folder}/{filename}")
+    try:
+        # only layer z is processed, so map the stack lazily rather than
+        # reading every plane into memory
+        stack = tifffile.memmap(f"{folder}/{filename}", mode="r")
+    except ValueError:
+        stack = imread(f"{folder}/{filename}")
     name = filename.split(".")[0]
     midline, contour, background, _, endoderm = load_labels_safe(folder, label_location, filename, endoderm=True)
-    layer = stack[z]
+    layer = np.asarray(stack[z])
     masks, cell_data = get_cell_data(layer[:, :, 3], diameter=diameter, polygon=contour)
     cell_data["z"] = z
     hcr_data = [None for _ in channel_names]